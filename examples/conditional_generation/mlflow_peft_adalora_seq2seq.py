@@ -1,22 +1,20 @@
+import inspect
+import math
 import os
 
 import torch
 from datasets import load_dataset
 from torch.utils.data import DataLoader
 from tqdm import tqdm
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, default_data_collator, get_linear_schedule_with_warmup
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, DataCollatorForSeq2Seq, get_linear_schedule_with_warmup
 
 from peft import AdaLoraConfig, PeftConfig, PeftModel, TaskType, get_peft_model
 import mlflow
 import time
 
-def get_num_parameters(model):
-  num_params = 0
-  for param in model.parameters():
-    num_params += param.numel()
+def get_num_parameters(model, trainable_only=False):
   # in million
-  num_params /= 10**6
-  return num_params
+  return sum(p.numel() for p in model.parameters() if p.requires_grad or not trainable_only) / 10**6
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -32,6 +30,9 @@ max_length = 128
 lr = 1e-3
 num_epochs = 8
 batch_size = 8
+num_workers = 4
+amp_dtype = torch.bfloat16
+seed = 42
 
 
 # creating model
@@ -51,6 +52,9 @@ peft_config = AdaLoraConfig(
 
 model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path)
 model = get_peft_model(model, peft_config)
+# frozen input embeddings need grads for checkpointed blocks to backprop into the adapters
+model.enable_input_require_grads()
+model.gradient_checkpointing_enable()
 model.print_trainable_parameters()
 
 mlflow_uri = os.environ.get("MLFLOW_TRACKING_URI")
@@ -64,10 +68,12 @@ mlflow_runner = mlflow.start_run(run_name=model_name_or_path, experiment_id=expe
 
 num_params = get_num_parameters(model)
 mlflow.log_param('num_params', num_params)
+mlflow.log_param('num_trainable_params', get_num_parameters(model, trainable_only=True))
 
 # loading dataset
 dataset = load_dataset("financial_phrasebank", "sentences_allagree")
-dataset = dataset["train"].train_test_split(test_size=0.1)
+# a fixed seed keeps the split fingerprint stable, so the `map` calls below hit the datasets cache on reruns
+dataset = dataset["train"].train_test_split(test_size=0.1, seed=seed)
 dataset["validation"] = dataset["test"]
 del dataset["test"]
 
@@ -75,7 +81,7 @@ classes = dataset["train"].features["label"].names
 dataset = dataset.map(
     lambda x: {"text_label": [classes[label] for label in x["label"]]},
     batched=True,
-    num_proc=1,
+    num_proc=os.cpu_count(),
 )
 
 
@@ -86,34 +92,54 @@ tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
 def preprocess_function(examples):
     inputs = examples[text_column]
     targets = examples[label_column]
-    model_inputs = tokenizer(inputs, max_length=max_length, padding="max_length", truncation=True, return_tensors="pt")
-    labels = tokenizer(targets, max_length=3, padding="max_length", truncation=True, return_tensors="pt")
-    labels = labels["input_ids"]
-    labels[labels == tokenizer.pad_token_id] = -100
-    model_inputs["labels"] = labels
+    # pad per batch in the collator; max_length only caps truncation
+    model_inputs = tokenizer(inputs, max_length=max_length, truncation=True)
+    labels = tokenizer(targets, max_length=3, truncation=True)
+    model_inputs["labels"] = labels["input_ids"]
     return model_inputs
 
 
 processed_datasets = dataset.map(
     preprocess_function,
     batched=True,
-    num_proc=1,
+    num_proc=os.cpu_count(),
     remove_columns=dataset["train"].column_names,
-    load_from_cache_file=False,
     desc="Running tokenizer on dataset",
 )
 
 train_dataset = processed_datasets["train"]
 eval_dataset = processed_datasets["validation"]
 
+# pads inputs to the longest sequence in the batch and labels with -100
+data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, padding="longest", label_pad_token_id=-100)
+
 train_dataloader = DataLoader(
-    train_dataset, shuffle=True, collate_fn=default_data_collator, batch_size=batch_size, pin_memory=True
+    train_dataset,
+    shuffle=True,
+    collate_fn=data_collator,
+    batch_size=batch_size,
+    num_workers=num_workers,
+    prefetch_factor=4,
+    persistent_workers=True,
+    pin_memory=True,
+)
+eval_dataloader = DataLoader(
+    eval_dataset,
+    collate_fn=data_collator,
+    batch_size=batch_size,
+    num_workers=num_workers,
+    prefetch_factor=4,
+    persistent_workers=True,
+    pin_memory=True,
 )
-eval_dataloader = DataLoader(eval_dataset, collate_fn=default_data_collator, batch_size=batch_size, pin_memory=True)
 
 
 # optimizer and lr scheduler
-optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+# the model is moved first because fused AdamW (torch>=2.0) only accepts CUDA parameters
+model = model.to(device)
+use_fused = "fused" in inspect.signature(torch.optim.AdamW).parameters and all(p.is_cuda for p in model.parameters())
+adamw_kwargs = {"fused": True} if use_fused else {"foreach": True}
+optimizer = torch.optim.AdamW(model.parameters(), lr=lr, **adamw_kwargs)
 lr_scheduler = get_linear_schedule_with_warmup(
     optimizer=optimizer,
     num_warmup_steps=0,
@@ -123,40 +149,50 @@ model.base_model.peft_config.total_step = len(train_dataloader) * num_epochs
 
 
 # training and evaluation
-model = model.to(device)
+# AdaLoRA prunes ranks by masking lora_E in place, so parameter shapes never change; dynamic=True
+# covers the per-batch sequence lengths from dynamic padding. `model` stays uncompiled for saving.
+compiled_model = torch.compile(model, dynamic=True) if hasattr(torch, "compile") else model
 global_step = 0
+train_steps = len(train_dataloader)
+eval_steps = len(eval_dataloader)
 
 with mlflow_runner:
     for epoch in range(num_epochs):
         model.train()
         total_loss = 0
         start_time = time.time()  # Start time for the epoch
-        for step, batch in enumerate(tqdm(train_dataloader)):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            outputs = model(**batch)
-            loss = outputs.loss
+        for step, batch in enumerate(tqdm(train_dataloader, mininterval=0.5)):
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+            # bf16 autocast needs no loss scaling, so backward/step stay unchanged
+            with torch.autocast(device_type=device, dtype=amp_dtype):
+                outputs = compiled_model(**batch)
+                loss = outputs.loss
             total_loss += loss.detach().float()
             loss.backward()
             optimizer.step()
             lr_scheduler.step()
             # Update the importance of low-rank matrices
             # and allocate the budget accordingly.
+            # This has to run every step: the importance EMA consumes each step's grads before tfinal,
+            # and the final rank pattern has to be re-applied after every optimizer update afterwards.
             model.base_model.update_and_allocate(global_step)
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             global_step += 1
 
+        # The only host sync of the epoch; it also makes end_time cover all queued GPU work
+        total_loss = total_loss.item()
         end_time = time.time()  # End time for the epoch
 
         # Calculate metrics
         epoch_runtime = end_time - start_time
-        samples_per_second = len(train_dataloader) / epoch_runtime
-        steps_per_second = len(train_dataloader) / epoch_runtime
+        samples_per_second = len(train_dataset) / epoch_runtime
+        steps_per_second = train_steps / epoch_runtime
 
         # Calculate average loss for the epoch
-        avg_loss = total_loss / len(train_dataloader)
+        train_epoch_loss = total_loss / train_steps
 
         # Log metrics for the epoch
-        mlflow.log_metric('loss', avg_loss)
+        mlflow.log_metric('loss', train_epoch_loss)
         mlflow.log_metric('total_loss', total_loss)
         mlflow.log_metric('train_runtime', epoch_runtime)
         mlflow.log_metric('train_samples_per_second', samples_per_second)
@@ -164,21 +200,30 @@ with mlflow_runner:
 
         model.eval()
         eval_loss = 0
-        eval_preds = []
-        for step, batch in enumerate(tqdm(eval_dataloader)):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            with torch.no_grad():
-                outputs = model(**batch)
+        preds_accum = []
+        for step, batch in enumerate(tqdm(eval_dataloader, mininterval=0.5)):
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+            with torch.inference_mode(), torch.autocast(device_type=device, dtype=amp_dtype):
+                outputs = compiled_model(**batch)
             loss = outputs.loss
             eval_loss += loss.detach().float()
-            eval_preds.extend(
-                tokenizer.batch_decode(torch.argmax(outputs.logits, -1).detach().cpu().numpy(), skip_special_tokens=True)
-            )
-
-        eval_epoch_loss = eval_loss / len(train_dataloader)
-        eval_ppl = torch.exp(eval_epoch_loss)
-        train_epoch_loss = total_loss / len(eval_dataloader)
-        train_ppl = torch.exp(train_epoch_loss)
+            # keep predictions on the GPU; they are copied back once after the loop
+            preds_accum.append(outputs.logits.argmax(-1))
+
+        # label lengths vary per batch with dynamic padding, so right-pad before concatenating
+        max_pred_len = max(preds.shape[-1] for preds in preds_accum)
+        all_preds = torch.cat(
+            [
+                torch.nn.functional.pad(preds, (0, max_pred_len - preds.shape[-1]), value=tokenizer.pad_token_id)
+                for preds in preds_accum
+            ],
+            dim=0,
+        )
+        eval_preds = tokenizer.batch_decode(all_preds.cpu().tolist(), skip_special_tokens=True)
+
+        eval_epoch_loss = eval_loss.item() / eval_steps
+        eval_ppl = math.exp(eval_epoch_loss)
+        train_ppl = math.exp(train_epoch_loss)
         print(f"{epoch=}: {train_ppl=} {train_epoch_loss=} {eval_ppl=} {eval_epoch_loss=}")
     mlflow.end_run()
 
@@ -218,7 +263,7 @@ inputs = tokenizer(dataset["validation"][text_column][i], return_tensors="pt")
 print(dataset["validation"][text_column][i])
 print(inputs)
 
-with torch.no_grad():
+with torch.inference_mode():
     outputs = model.generate(input_ids=inputs["input_ids"], max_new_tokens=10)
     print(outputs)
     print(tokenizer.batch_decode(outputs.detach().cpu().numpy(), skip_special_tokens=True))
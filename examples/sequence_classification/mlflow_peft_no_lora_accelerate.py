@@ -1,8 +1,11 @@
 import argparse
+import inspect
 import evaluate
 import torch
 from accelerate import Accelerator, DistributedDataParallelKwargs
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
+from datasets.config import HF_DATASETS_CACHE
+from datasets.fingerprint import Hasher
 from torch.optim import AdamW
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -15,14 +18,18 @@ from peft import (
 )
 from peft.utils.other import fsdp_auto_wrap_policy
 import mlflow
+from mlflow.entities import Metric
+from mlflow.tracking import MlflowClient
 import time
 import os
+import shutil
+import tempfile
 
 logging_steps = 100
 
 def parse_args():
     parser = argparse.ArgumentParser(description="PEFT a transformers model on a sequence classification task")
-    parser.add_argument('--log_interval', type=int, default=1, help='log interval.')
+    parser.add_argument('--log_interval', type=int, default=50, help='log interval.')
     parser.add_argument(
         "--num_virtual_tokens",
         type=int,
@@ -50,8 +57,14 @@ def parse_args():
     parser.add_argument(
         "--per_device_eval_batch_size",
         type=int,
-        default=8,
-        help="Batch size (per device) for the evaluation dataloader.",
+        default=None,
+        help="Batch size (per device) for the evaluation dataloader. Defaults to the training batch size.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of DataLoader worker processes; 0 loads batches in the main process.",
     )
     parser.add_argument(
         "--learning_rate",
@@ -74,7 +87,7 @@ def parse_args():
     )
     parser.add_argument('--dataset_name', type=str, default='glue', help='The name of the Dataset (from the HuggingFace hub) to train on.')
     parser.add_argument('--cache_dir', type=str, default=None, help='Directory to read/write data.')
-    parser.add_argument("--amp", type=str, choices=["bf16", "fp16", "no"], default="fp16", help="Choose AMP mode")
+    parser.add_argument("--amp", type=str, choices=["bf16", "fp16", "no"], default="bf16", help="Choose AMP mode")
     parser.add_argument("--optimizer", type=str, default="AdamW", help="Choose the optimization computation method")
     parser.add_argument('--checkpoint_dir', type=str, default= './save_checkpoint', help='Directory to save checkpoints.')
     parser.add_argument('--load_checkpoint', type=str, default="False", help='Load checkpoint or not.')
@@ -83,21 +96,84 @@ def parse_args():
 
     assert args.output_dir is not None, "Need an `output_dir` to store the finetune model and verify."
 
+    # eval keeps no activations for backward nor optimizer state, so it fits at least the training batch size
+    if args.per_device_eval_batch_size is None:
+        args.per_device_eval_batch_size = args.per_device_train_batch_size
+
     return args
 
-def get_num_parameters(model):
-  num_params = 0
-  for param in model.parameters():
-    num_params += param.numel()
+def get_num_parameters(model, trainable_only=False):
   # in million
-  num_params /= 10**6
-  return num_params
+  return sum(p.numel() for p in model.parameters() if p.requires_grad or not trainable_only) / 10**6
+
+def fetch_buffered_losses(loss_buffer):
+    """Copies the buffered `(step, loss)` pairs to the host in a single transfer and empties the buffer."""
+    if not loss_buffer:
+        return []
+    steps, losses = zip(*loss_buffer)
+    loss_buffer.clear()
+    return list(zip(steps, torch.stack(losses).float().cpu().tolist()))
+
+def log_losses(step_losses):
+    """Sends `(step, loss)` pairs to the active mlflow run with `log_batch` (at most 1000 metrics per request)."""
+    if not step_losses:
+        return
+    client = MlflowClient()
+    run_id = mlflow.active_run().info.run_id
+    timestamp = int(time.time() * 1000)
+    metrics = [Metric('loss', loss, timestamp, step) for step, loss in step_losses]
+    for i in range(0, len(metrics), 1000):
+        client.log_batch(run_id, metrics=metrics[i : i + 1000])
+
+def cuda_prefetcher(dataloader, device):
+    """Yields batches from `dataloader` on `device`, copying the next batch on a side stream during the current step."""
+    if device.type != "cuda":
+        for batch in dataloader:
+            yield {k: v.to(device) for k, v in batch.items()}
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+
+    def stage(batch):
+        with torch.cuda.stream(copy_stream):
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+            copied = torch.cuda.Event()
+            copied.record()
+        return batch, copied
+
+    def ready(batch, copied):
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(copied)
+        # the tensors were allocated on copy_stream; keep them alive until the compute stream is done with them
+        for v in batch.values():
+            v.record_stream(current_stream)
+        return batch
+
+    pending = None
+    for batch in dataloader:
+        staged = stage(batch)
+        if pending is not None:
+            yield ready(*pending)
+        pending = staged
+    if pending is not None:
+        yield ready(*pending)
 
 def main():
     args = parse_args()
     
-    ddp_scaler = DistributedDataParallelKwargs(find_unused_parameters=True)
+    # The frozen base model still feeds the loss, so DDP has no unused parameters to search for; set
+    # FIND_UNUSED_PARAMETERS=1 if a PEFT method ever trips DDP's unused-parameter check.
+    ddp_scaler = DistributedDataParallelKwargs(
+        find_unused_parameters=os.environ.get("FIND_UNUSED_PARAMETERS", "0") == "1",
+        gradient_as_bucket_view=True,
+    )
+    # bf16 needs no GradScaler; fall back to fp16 on GPUs without bf16 support (pre-Ampere)
+    bf16_fallback = args.amp == "bf16" and torch.cuda.is_available() and not torch.cuda.is_bf16_supported()
+    if bf16_fallback:
+        args.amp = "fp16"
     accelerator = Accelerator(mixed_precision=args.amp, kwargs_handlers=[ddp_scaler])
+    if bf16_fallback:
+        accelerator.print("bf16 is not supported on this device, falling back to fp16.")
 
     task = "mrpc"
 
@@ -142,39 +218,82 @@ def main():
     def collate_fn(examples):
         return tokenizer.pad(examples, padding="longest", return_tensors="pt")
 
+    # Tokenize once and keep the result on disk so later launches skip the map entirely. The directory name hashes
+    # the raw splits and `tokenize_function` (including the tokenizer), so changing either never reuses a stale cache.
+    tokenized_root = args.cache_dir or HF_DATASETS_CACHE
+    fingerprint = Hasher.hash((sorted((split, ds._fingerprint) for split, ds in datasets.items()), tokenize_function))
+    # The fingerprint identifies the data, so the dataset name (possibly a hub ID or local path) stays out of the path.
+    tokenized_dir = os.path.join(tokenized_root, f"{task}_tokenized_{fingerprint}")
     with accelerator.main_process_first():
-        tokenized_datasets = datasets.map(
-            tokenize_function,
-            batched=True,
-            remove_columns=["idx", "sentence1", "sentence2"],
-        )
+        if os.path.isdir(tokenized_dir):
+            tokenized_datasets = load_from_disk(tokenized_dir)
+        else:
+            tokenized_datasets = datasets.map(
+                tokenize_function,
+                batched=True,
+                num_proc=os.cpu_count(),
+                remove_columns=["idx", "sentence1", "sentence2"],
+                load_from_cache_file=True,
+            )
+            if accelerator.is_main_process:
+                # write next to the final location and rename, so an interrupted save never leaves a partial cache
+                os.makedirs(tokenized_root, exist_ok=True)
+                tmp_dir = tempfile.mkdtemp(prefix=".tokenized-", dir=tokenized_root)
+                tokenized_datasets.save_to_disk(tmp_dir)
+                try:
+                    os.rename(tmp_dir, tokenized_dir)
+                except OSError:
+                    # another launch already moved an identical cache into place
+                    shutil.rmtree(tmp_dir)
 
     # We also rename the 'label' column to 'labels' which is the expected name for labels by the models of the
     # transformers library
     tokenized_datasets = tokenized_datasets.rename_column("label", "labels")
 
     # Instantiate dataloaders.
+    # prefetch_factor and persistent_workers are only accepted together with worker processes
+    worker_kwargs = {"num_workers": args.num_workers}
+    if args.num_workers > 0:
+        worker_kwargs.update(prefetch_factor=4, persistent_workers=True)
     train_dataloader = DataLoader(
-        tokenized_datasets["train"], shuffle=True, collate_fn=collate_fn, batch_size=args.per_device_train_batch_size
+        tokenized_datasets["train"],
+        shuffle=True,
+        collate_fn=collate_fn,
+        batch_size=args.per_device_train_batch_size,
+        **worker_kwargs,
+        pin_memory=True,
     )
     eval_dataloader = DataLoader(
         tokenized_datasets["validation"],
         shuffle=False,
         collate_fn=collate_fn,
         batch_size=args.per_device_eval_batch_size,
+        **worker_kwargs,
+        pin_memory=True,
     )
 
     model = AutoModelForSequenceClassification.from_pretrained(args.model_name_or_path)
     model = get_peft_model(model, peft_config)
+    # Prefix tuning feeds the same prefix-encoder output to every layer as `past_key_value`, which the reentrant
+    # checkpoint in transformers 4.29 closes over instead of taking as an input, so backward would run through
+    # that graph once per layer. Prompt/P-tuning embeddings already require grad and checkpoint fine.
+    if args.peft_type != "prefix_tuning":
+        model.gradient_checkpointing_enable()
     model.print_trainable_parameters()
 
     if getattr(accelerator.state, "fsdp_plugin", None) is not None:
         accelerator.state.fsdp_plugin.auto_wrap_policy = fsdp_auto_wrap_policy(model)
         model = accelerator.prepare(model)
+    else:
+        # fused AdamW checks at construction that every parameter is already on the GPU
+        model = model.to(accelerator.device)
 
-    
     if args.optimizer == "AdamW":
-        optimizer = torch.optim.AdamW(params=model.parameters(), lr=args.learning_rate)
+        use_fused = "fused" in inspect.signature(torch.optim.AdamW).parameters and all(
+            p.is_cuda for p in model.parameters()
+        )
+        adamw_kwargs = {"fused": True} if use_fused else {"foreach": True}
+        optimizer = torch.optim.AdamW(params=model.parameters(), lr=args.learning_rate, **adamw_kwargs)
     elif args.optimizer == "SGD":
         optimizer = torch.optim.SGD(params=model.parameters(), lr=args.learning_rate)
     elif args.optimizer == "Adam":
@@ -192,7 +311,8 @@ def main():
     if args.load_checkpoint == "True":
         if os.path.exists(args.checkpoint_dir):
             checkpoint = torch.load(args.checkpoint_dir)
-            model.load_state_dict(checkpoint['model_state_dict'])
+            # the checkpoint only holds the trainable tensors; the frozen base weights come from the hub
+            accelerator.unwrap_model(model).load_state_dict(checkpoint['model_state_dict'], strict=False)
             optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
             epoch = checkpoint['epoch']
             loss = checkpoint['loss']
@@ -200,40 +320,55 @@ def main():
             pass
 
     if getattr(accelerator.state, "fsdp_plugin", None) is not None:
-        train_dataloader, eval_dataloader, optimizer, lr_scheduler = accelerator.prepare(
-            train_dataloader, eval_dataloader, optimizer, lr_scheduler
-        )
+        train_dataloader, optimizer, lr_scheduler = accelerator.prepare(train_dataloader, optimizer, lr_scheduler)
     else:
-        model, train_dataloader, eval_dataloader, optimizer, lr_scheduler = accelerator.prepare(
-            model, train_dataloader, eval_dataloader, optimizer, lr_scheduler
+        model, train_dataloader, optimizer, lr_scheduler = accelerator.prepare(
+            model, train_dataloader, optimizer, lr_scheduler
         )
+    # Eval batches are still sharded across processes, but moved to the device by `cuda_prefetcher`.
+    eval_dataloader = accelerator.prepare_data_loader(eval_dataloader, device_placement=False)
+    # Padding to the longest sequence changes the input shapes per batch, hence dynamic=True.
+    # `model` stays uncompiled for checkpointing.
+    compiled_model = torch.compile(model, dynamic=True) if hasattr(torch, "compile") else model
     mlflow.start_run()
     num_params = get_num_parameters(model)
     mlflow.log_param('num_params', num_params)
+    mlflow.log_param('num_trainable_params', get_num_parameters(model, trainable_only=True))
 
     elapsed = 0
     epoch_runtime_list = []
+    # Losses stay on the device until a log boundary so that steps in between don't sync with the host.
+    loss_buffer = []
     for epoch in range(args.num_train_epochs):
         start_time = time.time()
         model.train()
         total_loss = 0
 
-        for step, batch in enumerate(tqdm(train_dataloader)):
+        train_progress = tqdm(
+            train_dataloader, mininterval=1.0, miniters=50, disable=not accelerator.is_main_process
+        )
+        for step, batch in enumerate(train_progress):
             start_time_step = time.time()
-            outputs = model(**batch)
+            outputs = compiled_model(**batch)
             loss = outputs.loss
             total_loss += loss.detach().float()
             accelerator.backward(loss)
             optimizer.step()
             lr_scheduler.step()
-            optimizer.zero_grad()
-            elapsed += time.time() - start_time_step
+            optimizer.zero_grad(set_to_none=True)
             total_steps = epoch * len(train_dataloader) + step + 1
+            loss_buffer.append((total_steps, loss.detach()))
             if total_steps % args.log_interval == 0:
+                # the fetch synchronizes, so `elapsed` includes all work queued so far but none of the logging I/O
+                step_losses = fetch_buffered_losses(loss_buffer)
+                elapsed += time.time() - start_time_step
+                log_losses(step_losses)
                 thoughput = total_steps * args.per_device_train_batch_size/ elapsed
                 mlflow.log_metric('throughput', thoughput, step=total_steps)
-                mlflow.log_metric('loss', loss, step=total_steps)
                 mlflow.log_metric('lr', lr_scheduler.get_last_lr()[0], step=total_steps)
+            else:
+                elapsed += time.time() - start_time_step
+        log_losses(fetch_buffered_losses(loss_buffer))
 
         end_time = time.time()  # End time for the epoch
 
@@ -247,9 +382,16 @@ def main():
 
     model.eval()
     samples_seen = 0
-    for step, batch in enumerate(tqdm(eval_dataloader)):
-        with torch.no_grad():
-            outputs = model(**batch)
+    # Gathered predictions stay on the device; the metric is fed and computed once after the loop.
+    all_predictions = []
+    all_references = []
+    eval_batches = cuda_prefetcher(eval_dataloader, accelerator.device)
+    eval_progress = tqdm(
+        eval_batches, total=len(eval_dataloader), mininterval=1.0, miniters=50, disable=not accelerator.is_main_process
+    )
+    for step, batch in enumerate(eval_progress):
+        with torch.inference_mode():
+            outputs = compiled_model(**batch)
         predictions = outputs.logits.argmax(dim=-1)
         predictions, references = accelerator.gather((predictions, batch["labels"]))
         # If we are in a multiprocess environment, the last batch has duplicates
@@ -259,16 +401,18 @@ def main():
                 references = references[: len(eval_dataloader.dataset) - samples_seen]
             else:
                 samples_seen += references.shape[0]
-        metric.add_batch(
-            predictions=predictions,
-            references=references,
-        )
-        eval_metric = metric.compute()
-        
-        accelerator.print(f"epoch {epoch}:", eval_metric)
-        accuracy = eval_metric.get('accuracy', None)
+        all_predictions.append(predictions)
+        all_references.append(references)
+    metric.add_batch(
+        predictions=torch.cat(all_predictions),
+        references=torch.cat(all_references),
+    )
+    eval_metric = metric.compute()
+
+    accelerator.print(f"epoch {epoch}:", eval_metric)
+    accuracy = eval_metric.get('accuracy', None)
 
-        mlflow.log_metric('accuracy', accuracy)
+    mlflow.log_metric('accuracy', accuracy)
     mlflow.end_run()
     
     accelerator.wait_for_everyone()
@@ -277,7 +421,12 @@ def main():
             os.makedirs(os.path.dirname(args.checkpoint_dir), exist_ok=True)
             torch.save({
             'epoch': args.num_train_epochs - 1,
-            'model_state_dict': model.state_dict(),
+            # Only the trainable tensors (prompt encoder and the `modules_to_save` classifier). This is a resume
+            # checkpoint, so `get_peft_model_state_dict` is not used: for prompt learning it exports the encoded
+            # virtual tokens instead of the prompt-encoder weights the optimizer state refers to.
+            'model_state_dict': {
+                n: p for n, p in accelerator.unwrap_model(model).named_parameters() if p.requires_grad
+            },
             'optimizer_state_dict': optimizer.state_dict(),
             'lr_scheduler_state_dict': lr_scheduler.state_dict(),
             'loss': loss,
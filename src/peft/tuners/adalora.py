@@ -531,6 +531,7 @@ class RankAllocator(object):
 
         self.reset_ipt()
         self._set_budget_scheduler(model)
+        self._rank_pattern_masks = None
 
     def set_total_step(self, total_step):
         self.peft_config.total_step = total_step
@@ -660,14 +661,24 @@ class RankAllocator(object):
         return budget, rank_pattern
 
     def mask_using_rank_pattern(self, model, rank_pattern):
-        # Mask the unimportant triplets
-        is_adapter_name_truncated = False
-        if self.adapter_name not in next(iter(rank_pattern.keys())):
-            is_adapter_name_truncated = True
-
-        with torch.no_grad():
+        # The rank pattern is fixed once the budget is finalized, so the device masks are built once and reused
+        # for every subsequent step instead of being copied from host lists each time
+        if self._rank_pattern_masks is None or self._rank_pattern_masks[0] is not rank_pattern:
+            is_adapter_name_truncated = False
+            if self.adapter_name not in next(iter(rank_pattern.keys())):
+                is_adapter_name_truncated = True
+
+            pruned_masks = {}
             for n, p in model.named_parameters():
                 if f"lora_E.{self.adapter_name}" in n:
                     key = n if not is_adapter_name_truncated else n.replace(f".{self.adapter_name}", "")
                     mask = torch.Tensor(rank_pattern[key]).unsqueeze(-1).to(p.device)
-                    p.masked_fill_(~mask.bool(), 0.0)
+                    pruned_masks[n] = ~mask.bool()
+            self._rank_pattern_masks = (rank_pattern, pruned_masks)
+
+        pruned_masks = self._rank_pattern_masks[1]
+        # Mask the unimportant triplets
+        with torch.no_grad():
+            for n, p in model.named_parameters():
+                if n in pruned_masks:
+                    p.masked_fill_(pruned_masks[n], 0.0)
@@ -0,0 +1,89 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import torch
+import torch.nn as nn
+
+from peft import AdaLoraConfig
+from peft.tuners.adalora import RankAllocator
+
+
+class TinyAdaLoraLayer(nn.Module):
+    def __init__(self, r, in_features, out_features, adapter_name="default"):
+        super().__init__()
+        self.lora_A = nn.ParameterDict({adapter_name: nn.Parameter(torch.ones(r, in_features))})
+        self.lora_E = nn.ParameterDict({adapter_name: nn.Parameter(torch.ones(r, 1))})
+        self.lora_B = nn.ParameterDict({adapter_name: nn.Parameter(torch.ones(out_features, r))})
+
+
+class TinyAdaLoraModel(nn.Module):
+    def __init__(self, r=4):
+        super().__init__()
+        self.q = TinyAdaLoraLayer(r, 8, 8)
+        self.v = TinyAdaLoraLayer(r, 8, 8)
+
+
+class RankAllocatorMaskTester(unittest.TestCase):
+    def setUp(self):
+        self.model = TinyAdaLoraModel()
+        config = AdaLoraConfig(init_r=4, target_r=2, total_step=10)
+        self.rankallocator = RankAllocator(self.model, config, "default")
+
+    def _fill_lora_E(self, value):
+        with torch.no_grad():
+            for n, p in self.model.named_parameters():
+                if "lora_E" in n:
+                    p.fill_(value)
+
+    def test_pruned_ranks_stay_masked_across_calls(self):
+        rank_pattern = {
+            "q.lora_E.default": [True, False, True, False],
+            "v.lora_E.default": [False, False, True, True],
+        }
+        for _ in range(3):
+            # the optimizer step overwrites the pruned singular values between calls
+            self._fill_lora_E(1.0)
+            self.rankallocator.mask_using_rank_pattern(self.model, rank_pattern)
+            self.assertEqual(self.model.q.lora_E["default"].view(-1).tolist(), [1.0, 0.0, 1.0, 0.0])
+            self.assertEqual(self.model.v.lora_E["default"].view(-1).tolist(), [0.0, 0.0, 1.0, 1.0])
+
+    def test_new_rank_pattern_rebuilds_masks(self):
+        rank_pattern = {
+            "q.lora_E.default": [True, True, False, False],
+            "v.lora_E.default": [True, True, False, False],
+        }
+        self.rankallocator.mask_using_rank_pattern(self.model, rank_pattern)
+
+        new_rank_pattern = {
+            "q.lora_E.default": [False, False, True, True],
+            "v.lora_E.default": [True, False, True, False],
+        }
+        self._fill_lora_E(1.0)
+        self.rankallocator.mask_using_rank_pattern(self.model, new_rank_pattern)
+        self.assertEqual(self.model.q.lora_E["default"].view(-1).tolist(), [0.0, 0.0, 1.0, 1.0])
+        self.assertEqual(self.model.v.lora_E["default"].view(-1).tolist(), [1.0, 0.0, 1.0, 0.0])
+
+    def test_truncated_adapter_name_keys(self):
+        # rank patterns loaded from a saved config have the adapter name stripped from their keys
+        rank_pattern = {
+            "q.lora_E": [False, True, True, True],
+            "v.lora_E": [True, True, True, False],
+        }
+        for _ in range(2):
+            self._fill_lora_E(1.0)
+            self.rankallocator.mask_using_rank_pattern(self.model, rank_pattern)
+            self.assertEqual(self.model.q.lora_E["default"].view(-1).tolist(), [0.0, 1.0, 1.0, 1.0])
+            self.assertEqual(self.model.v.lora_E["default"].view(-1).tolist(), [1.0, 1.0, 1.0, 0.0])